@@ -1,33 +1,83 @@
 import os
+import sys
 from dotenv import load_dotenv
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 import asyncio
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from concurrent.futures import TimeoutError
 import logging
-from datetime import datetime
-import traceback
+import logging.handlers
+import queue
+import atexit
+import contextvars
+import functools
+from datetime import datetime, timedelta
 import json
+import hashlib
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+try:
+    import orjson  # optional, faster JSON serialization
+except ImportError:
+    orjson = None
 
-# Configure logging
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging (set LOG_LEVEL=DEBUG in the environment for verbose output)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 log_dir = "logs"
 os.makedirs(log_dir, exist_ok=True)
 log_file = os.path.join(log_dir, f"math_agent_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
 
+class BufferedFileHandler(logging.StreamHandler):
+    """Log handler that leaves flushing to the stream's own buffer instead of flushing every record."""
+
+    def flush(self):
+        pass
+
+class DeferredFormatQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves all formatting, including tracebacks, to the listener's handlers.
+
+    The stock prepare() formats the message and exc_info on the calling thread;
+    the queue is in-process, so the record can be passed through untouched.
+    """
+
+    def prepare(self, record):
+        return record
+
+# Records are queued on the calling thread and written by a background listener,
+# so logging in the agent loop never blocks the event loop on file/console I/O.
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+log_stream = open(log_file, "a", encoding="utf-8", buffering=65536)
+file_handler = BufferedFileHandler(log_stream)
+file_handler.setFormatter(log_formatter)
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(log_formatter)
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+log_listener.start()
+
+def stop_logging():
+    """Drain queued log records and flush the log file."""
+    log_listener.stop()
+    log_stream.close()
+
+atexit.register(stop_logging)
+
 logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
+    level=LOG_LEVEL,
+    handlers=[DeferredFormatQueueHandler(log_queue)]
 )
 logger = logging.getLogger(__name__)
 
-# Load environment variables from .env file
-load_dotenv()
-
 # Access your API key and initialize Gemini client correctly
 api_key = os.getenv("GEMINI_API_KEY")
 if not api_key:
@@ -37,17 +87,61 @@ if not api_key:
 # Configure the Gemini API
 genai.configure(api_key=api_key)
 
-model = genai.GenerativeModel('gemini-2.5-flash')
-
 # Constants
+MODEL_NAME = 'gemini-2.5-flash'
+SYSTEM_PROMPT_CACHE_TTL = timedelta(hours=1)
 MAX_ITERATIONS = 5
+LLM_TIMEOUT = 10  # seconds
+GEMINI_QPS = int(os.getenv("GEMINI_QPS", "8"))  # max Gemini requests per second (and in flight per event loop)
+LLM_MAX_RETRIES = 3  # retries after a 429 / ResourceExhausted response
+LLM_RETRY_BASE_DELAY = 1  # seconds, doubled on each retry
+MAX_RESULT_CHARS = 2048  # longer tool results are truncated before being added to the prompt
+TRUNCATION_MARKER = " ...[truncated]"
 FUNCTION_CALL_PREFIX = "FUNCTION_CALL:"
 
-# Global variables
-last_response = None
-iteration = 0
-iteration_response = []
-conversation_history = []
+if GEMINI_QPS <= 0:
+    logger.error(f"GEMINI_QPS must be a positive integer, got {GEMINI_QPS}")
+    raise ValueError(f"GEMINI_QPS must be a positive integer, got {GEMINI_QPS}")
+
+# Precompiled patterns for parsing LLM responses
+_FIRST_LINE_RE = re.compile(r'\S[^\n]*')
+_FUNCTION_CALL_BLOCK_RE = re.compile(r'\A(?:\s*FUNCTION_CALL:[^\n]*)+')
+_FUNCTION_CALL_RE = re.compile(r'^\s*FUNCTION_CALL:\s*(.*?)\s*$', re.M)
+_FINAL_ANSWER_RE = re.compile(r'^\s*FINAL_ANSWER:\s*(.*?)\s*$')
+
+# MCP connection settings (seconds)
+MCP_CONNECT_TIMEOUT = 30
+MCP_PING_INTERVAL = 30
+MCP_PING_TIMEOUT = 10
+MCP_RECONNECT_DELAY = 1
+
+# Tools whose calls must keep their relative order (they mutate PowerPoint or send email)
+SIDE_EFFECT_TOOLS = frozenset({
+    "open_powerpoint",
+    "draw_rectangle",
+    "add_text_in_powerpoint",
+    "close_powerpoint",
+    "send_gmail",
+})
+# Side-effect tools whose repeat with the same arguments is skipped once a call succeeded.
+# PowerPoint calls are never skipped: their effect depends on the presentation's current state.
+SEND_ONCE_TOOLS = frozenset({"send_gmail"})
+
+# LLM response cache settings
+LLM_CACHE_FILE = os.path.join(log_dir, "llm_cache.json")
+LLM_CACHE_MAX_SIZE = 1024
+
+@dataclass
+class AgentState:
+    """Per-query state, so that several queries can be served concurrently."""
+    iteration: int = 0
+    # Steps taken since the last model turn; sent as the next user turn, then cleared
+    iteration_response: list = field(default_factory=list)
+    # Chat turns ({"role": ..., "parts": [...]}) sent to Gemini; each iteration adds one user and one model turn
+    messages: list = field(default_factory=list)
+    # (tool name, canonical JSON of arguments) -> result, so repeated calls are not re-executed
+    # (PowerPoint tools are never cached, see SEND_ONCE_TOOLS)
+    call_cache: dict = field(default_factory=dict)
 
 # System prompt template (to be formatted with tools_description)
 SYSTEM_PROMPT_TEMPLATE = """
@@ -79,7 +173,6 @@ Important Rules:
 - Tag each step with the reasoning type.
 - Always do a SELF_CHECK after calculation or verification.
 - If a tool fails or you are uncertain, use a fallback_reasoning call.
-- Maintain conversation_history and update it each round.
 - ONLY perform the exact operations requested by the user.
 - Do not repeat function calls with the same parameters.
 - Only give FINAL_ANSWER when you have completed all necessary operations.
@@ -111,19 +204,191 @@ SELF_CHECK: Is the result reasonable? -> Yes
 FINAL_ANSWER: [Query: Add 2 and 3. Result: 5]
 """
 
-async def generate_with_timeout(model, prompt):
-    """Generate content with a timeout"""
+def load_llm_cache():
+    """Load the persisted LLM response cache from disk."""
+    try:
+        with open(LLM_CACHE_FILE, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        logger.info(f"Loaded {len(entries)} cached LLM responses")
+        return OrderedDict(list(entries.items())[-LLM_CACHE_MAX_SIZE:])
+    except FileNotFoundError:
+        return OrderedDict()
+    except Exception as e:
+        logger.warning(f"Could not load LLM cache: {e}")
+        return OrderedDict()
+
+def save_llm_cache():
+    """Persist the LLM response cache to disk (called at exit).
+
+    Writes to a temporary file and renames it over the cache file, so an
+    interrupted write never leaves a truncated cache behind.
+    """
+    with _exact_cache_lock:
+        entries = dict(_exact_cache)
+    tmp_file = f"{LLM_CACHE_FILE}.tmp"
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(tmp_file, LLM_CACHE_FILE)
+    except Exception as e:
+        logger.warning(f"Could not save LLM cache: {e}")
+
+# Models bound to a system prompt, keyed by SHA-256 of the prompt: digest -> (model, expires_at)
+_system_prompt_models = {}
+
+def get_model(system_prompt):
+    """Return a model with the system prompt attached, using Gemini context caching when possible.
+
+    The static system prompt is uploaded once as cached content so that each
+    iteration only sends the per-query part of the prompt. If context caching
+    is unavailable (e.g. the prompt is below the minimum cacheable size), the
+    system prompt is passed as a regular system instruction instead.
+    """
+    digest = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+    entry = _system_prompt_models.get(digest)
+    if entry is not None and (entry[1] is None or entry[1] > datetime.now()):
+        return entry[0]
+
+    try:
+        cached_content = genai.caching.CachedContent.create(
+            model=f"models/{MODEL_NAME}",
+            system_instruction=system_prompt,
+            ttl=SYSTEM_PROMPT_CACHE_TTL
+        )
+        model = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+        # Refresh a minute early so an in-flight query never hits an expired cache
+        expires_at = datetime.now() + SYSTEM_PROMPT_CACHE_TTL - timedelta(minutes=1)
+        logger.info("Created Gemini context cache for system prompt")
+    except Exception as e:
+        logger.warning(f"Context caching unavailable, sending system instruction per request: {e}")
+        model = genai.GenerativeModel(MODEL_NAME, system_instruction=system_prompt)
+        expires_at = None
+    _system_prompt_models[digest] = (model, expires_at)
+    return model
+
+# Exact-match LLM response cache keyed by SHA-256 of the prompt (LRU order)
+_exact_cache = load_llm_cache()
+_exact_cache_lock = threading.Lock()
+atexit.register(save_llm_cache)
+
+def stream_until_actionable(model, contents):
+    """Stream a response and stop reading as soon as the parser has all it needs.
+
+    process_llm_response acts only on the leading block of FUNCTION_CALL lines,
+    or on the first line otherwise, so generation is abandoned at the first
+    complete line that is not a FUNCTION_CALL. Blocking; run it in a thread.
+    """
+    text = ""
+    scan_from = 0
+    for chunk in model.generate_content(contents, stream=True):
+        text += chunk.text
+        newline = text.find("\n", scan_from)
+        while newline != -1:
+            line = text[scan_from:newline].strip()
+            scan_from = newline + 1
+            if line and not line.startswith(FUNCTION_CALL_PREFIX):
+                logger.info("Stopping LLM stream early, response is actionable")
+                return text[:newline]
+            newline = text.find("\n", scan_from)
+    return text
+
+# One semaphore per event loop (server.py runs each request in its own loop)
+_gemini_semaphores = weakref.WeakKeyDictionary()
+# Token bucket shared by all loops: monotonic time of the next free request slot
+_next_llm_slot = 0.0
+_llm_slot_lock = threading.Lock()
+
+def gemini_semaphore():
+    """Return the semaphore bounding concurrent Gemini calls on the running loop.
+
+    The bound is per event loop; queries served through main() all run on the
+    SharedAgent's loop. The reserve_llm_slot() rate limit is process-wide.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _gemini_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _gemini_semaphores[loop] = asyncio.Semaphore(GEMINI_QPS)
+    return semaphore
+
+def reserve_llm_slot():
+    """Reserve the next GEMINI_QPS rate-limit slot and return how long to wait for it."""
+    global _next_llm_slot
+    with _llm_slot_lock:
+        now = time.monotonic()
+        slot = max(now, _next_llm_slot)
+        _next_llm_slot = slot + 1 / GEMINI_QPS
+    return slot - now
+
+async def run_in_thread_with_timeout(func, *args, timeout):
+    """Run a blocking call in the default executor and give up after `timeout` seconds.
+
+    Behaves like asyncio.wait_for(asyncio.to_thread(func, *args), timeout), but
+    awaits the executor future directly and expires it with a loop timer, so no
+    extra Tasks are scheduled per call.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    future = loop.run_in_executor(None, functools.partial(ctx.run, func, *args))
+    timed_out = False
+
+    def expire():
+        nonlocal timed_out
+        timed_out = True
+        future.cancel()
+
+    handle = loop.call_later(timeout, expire)
+    try:
+        return await future
+    except asyncio.CancelledError:
+        if timed_out:
+            raise TimeoutError(f"{func.__name__} did not finish within {timeout}s") from None
+        raise
+    finally:
+        handle.cancel()
+
+async def generate_with_timeout(model, contents, cache_namespace=""):
+    """Generate content with a timeout, reusing cached responses for identical conversations.
+
+    contents is a prompt string or a list of chat turns. cache_namespace
+    separates cache entries for conversations held under different system
+    prompts (the system prompt itself is not part of `contents`).
+    """
+    serialized = contents if isinstance(contents, str) else json.dumps(contents, ensure_ascii=False)
+    key = hashlib.sha256(f"{cache_namespace}\0{serialized}".encode("utf-8")).hexdigest()
+    with _exact_cache_lock:
+        cached = _exact_cache.get(key)
+        if cached is not None:
+            _exact_cache.move_to_end(key)
+            logger.info("LLM cache hit, skipping generation")
+            return cached
     logger.info("Starting LLM generation...")
     try:
-        # Convert the synchronous generate_content call to run in a thread
-        loop = asyncio.get_event_loop()
-        async with asyncio.timeout(10):
-            response = await loop.run_in_executor(
-                None, 
-                lambda: model.generate_content(prompt)
-            )
+        async with gemini_semaphore():
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                wait = reserve_llm_slot()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    # Run the synchronous streaming call in a thread
+                    response_text = await run_in_thread_with_timeout(
+                        stream_until_actionable, model, contents, timeout=LLM_TIMEOUT
+                    )
+                    break
+                except google_exceptions.ResourceExhausted:
+                    if attempt == LLM_MAX_RETRIES:
+                        raise
+                    delay = LLM_RETRY_BASE_DELAY * 2 ** attempt
+                    logger.warning(f"Gemini rate limit hit, retrying in {delay}s")
+                    await asyncio.sleep(delay)
         logger.info("LLM generation completed")
-        return response.text
+        # Only cache responses the agent can act on, so a malformed reply is not replayed forever
+        if is_actionable_response(response_text):
+            with _exact_cache_lock:
+                _exact_cache[key] = response_text
+                _exact_cache.move_to_end(key)
+                while len(_exact_cache) > LLM_CACHE_MAX_SIZE:
+                    _exact_cache.popitem(last=False)
+        return response_text
     except TimeoutError:
         logger.error("LLM generation timed out!")
         raise
@@ -131,19 +396,30 @@ async def generate_with_timeout(model, prompt):
         logger.error(f"Error in LLM generation: {e}")
         raise
 
-def reset_state():
-    """Reset all global variables to their initial state"""
-    global last_response, iteration, iteration_response, conversation_history
-    last_response = None
-    iteration = 0
-    iteration_response = []
-    conversation_history = []
-    logger.debug("Reset global state")
+# Tools descriptions keyed by tools_cache_key() of the tool list they describe
+_tools_desc_cache = {}
+
+def tools_cache_key(tools):
+    """Hashable key identifying a tool list by each tool's name, description and input schema."""
+    return hash(tuple(
+        (t.name, getattr(t, 'description', None), json.dumps(t.inputSchema, sort_keys=True))
+        for t in tools
+    ))
 
 def create_tools_description(tools):
-    """Create a formatted description of available tools."""
+    """Create a formatted description of available tools (memoized per tool list)."""
+    try:
+        key = tools_cache_key(tools)
+    except Exception as e:
+        logger.warning(f"Could not compute tools cache key: {e}")
+        key = None
+    if key is not None and key in _tools_desc_cache:
+        logger.info("Reusing cached tools description")
+        return _tools_desc_cache[key]
+
     logger.info("Creating tools description...")
-    logger.debug(f"Number of tools: {len(tools)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Number of tools: {len(tools)}")
     
     try:
         tools_description = []
@@ -153,80 +429,159 @@ def create_tools_description(tools):
                 params = tool.inputSchema
                 desc = getattr(tool, 'description', 'No description available')
                 name = getattr(tool, 'name', f'tool_{i}')
+                properties = params.get('properties')
                 
                 # Format the input schema in a more readable way
-                if 'properties' in params:
-                    param_details = []
-                    for param_name, param_info in params['properties'].items():
-                        param_type = param_info.get('type', 'unknown')
-                        param_details.append(f"{param_name}: {param_type}")
-                    params_str = ', '.join(param_details)
+                if properties is not None:
+                    params_str = ', '.join(
+                        f"{param_name}: {param_info.get('type', 'unknown')}"
+                        for param_name, param_info in properties.items()
+                    )
                 else:
                     params_str = 'no parameters'
 
                 tool_desc = f"{i+1}. {name}({params_str}) - {desc}"
                 tools_description.append(tool_desc)
-                logger.debug(f"Added description for tool: {tool_desc}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Added description for tool: {tool_desc}")
             except Exception as e:
                 logger.error(f"Error processing tool {i}: {e}")
                 tools_description.append(f"{i+1}. Error processing tool")
         
         tools_description = "\n".join(tools_description)
+        if key is not None:
+            _tools_desc_cache[key] = tools_description
         logger.info("Successfully created tools description")
         return tools_description
     except Exception as e:
         logger.error(f"Error creating tools description: {e}")
         return "Error loading tools"
 
-def find_tool_by_name(tools, func_name):
-    """Helper to find a tool by name."""
-    return next((t for t in tools if t.name == func_name), None)
+_NUMBER_RE = re.compile(r'-?\d+(?:\.\d+)?')
 
-def parse_arguments(args, schema_properties):
-    """Helper to parse arguments according to schema."""
-    arguments = {}
+def _parse_array(value):
+    """Pass lists through; decode a string such as '[2, 3.5]' as JSON, else extract its numbers.
+
+    A string with no numbers is returned unchanged, so the MCP server rejects
+    it instead of receiving an empty list.
+    """
+    if isinstance(value, str):
+        try:
+            parsed = json.loads(value)
+        except ValueError:
+            parsed = None
+        if isinstance(parsed, list):
+            return parsed
+        numbers = _NUMBER_RE.findall(value)
+        if numbers:
+            return [float(x) if '.' in x else int(x) for x in numbers]
+    return value
+
+# Schema type -> converter for positional arguments; unknown types are passed as strings
+CONVERTERS = {
+    'integer': int,
+    'number': float,
+    'array': _parse_array,
+}
+
+def compile_arg_builder(func_name, param_specs):
+    """Generate a function that maps a full positional args list to a tool's keyword arguments.
+
+    The field names and converters of the tool's schema are baked into the
+    generated source, e.g. for add(a: integer, b: integer):
+
+        def build_args_add(p):
+            return {'a': _conv_0(p[0]), 'b': _conv_1(p[1])}
+    """
+    fn_name = "build_args_" + re.sub(r'\W', '_', func_name)
+    namespace = {}
+    fields = []
+    for i, (param_name, param_type) in enumerate(param_specs):
+        namespace[f"_conv_{i}"] = CONVERTERS.get(param_type, str)
+        fields.append(f"{param_name!r}: _conv_{i}(p[{i}])")
+    src = f"def {fn_name}(p):\n    return {{{', '.join(fields)}}}\n"
+    exec(compile(src, f"<arg builder for {func_name}>", "exec"), namespace)
+    return namespace[fn_name]
+
+@dataclass
+class ToolIndex:
+    """Lookup tables built once per tool list for the per-call hot path."""
+    # Tool name -> tuple of (param_name, param_type) in schema order
+    params: dict
+    # Tool name -> compiled builder for a complete positional args list
+    builders: dict
+
+    @classmethod
+    def from_tools(cls, tools):
+        params = {
+            t.name: tuple(
+                (param_name, param_info.get('type', 'string'))
+                for param_name, param_info in t.inputSchema.get('properties', {}).items()
+            )
+            for t in tools
+        }
+        return cls(
+            params=params,
+            builders={name: compile_arg_builder(name, specs) for name, specs in params.items()}
+        )
+
+def parse_arguments(args, param_specs):
+    """Helper to parse positional arguments according to a tool's (name, type) parameter specs."""
     if isinstance(args, dict):
         return args
     elif isinstance(args, list):
-        for (param_name, param_info), value in zip(schema_properties.items(), args):
-            param_type = param_info.get('type', 'string')
-            if param_type == 'integer':
-                arguments[param_name] = int(value)
-            elif param_type == 'number':
-                arguments[param_name] = float(value)
-            elif param_type == 'array':
-                arguments[param_name] = value
-            else:
-                arguments[param_name] = str(value)
-        return arguments
+        converters = CONVERTERS
+        return {
+            param_name: converters.get(param_type, str)(value)
+            for (param_name, param_type), value in zip(param_specs, args)
+        }
     else:
         return args
 
-async def execute_tool(session, tools, call, iteration_response, conversation_history):
+def side_effect_succeeded(result, iteration_result):
+    """Whether a SIDE_EFFECT_TOOLS call succeeded.
+
+    These tools report failures as returned error text rather than raising, and
+    every success message contains "successfully".
+    """
+    if getattr(result, 'isError', False):
+        return False
+    texts = iteration_result if isinstance(iteration_result, list) else [iteration_result]
+    return any("successfully" in text for text in texts)
+
+async def call_tool(session, tool_index, call, state):
+    """Invoke a single parsed FUNCTION_CALL and return (arguments, result, repeated).
+
+    The result is None when the tool is unknown. A call repeating an earlier
+    call of the same query with the same arguments returns the earlier result
+    with repeated=True, without contacting the MCP server. PowerPoint tools are
+    always executed; send_gmail is only deduplicated after a successful call,
+    so it sends at most once but a failed send can be retried.
+    """
     func_name = call.get("name")
     args = call.get("args", [])
-    reasoning_type = call.get("reasoning_type", "")
-    step_desc = call.get("step", "")
-    logger.debug(f"Parsed function call: {call}")
-
-    tool = find_tool_by_name(tools, func_name)
-    if not tool:
-        logger.debug(f"Available tools: {[t.name for t in tools]}")
-        iteration_response.append(f"Unknown tool: {func_name}")
-        conversation_history.append({
-            "type": "function_call",
-            "name": func_name,
-            "args": args,
-            "reasoning_type": reasoning_type,
-            "step": step_desc,
-            "result": "Unknown tool"
-        })
-        return None, iteration_response, conversation_history
-
-    schema_properties = tool.inputSchema.get('properties', {})
-    arguments = parse_arguments(args, schema_properties)
-
-    logger.debug(f"Final arguments: {arguments}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Parsed function call: {call}")
+
+    param_specs = tool_index.params.get(func_name)
+    if param_specs is None:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Available tools: {list(tool_index.params)}")
+        return args, None, False
+
+    if isinstance(args, list) and len(args) == len(param_specs):
+        arguments = tool_index.builders[func_name](args)
+    else:
+        arguments = parse_arguments(args, param_specs)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Final arguments: {arguments}")
+    cacheable = func_name not in SIDE_EFFECT_TOOLS or func_name in SEND_ONCE_TOOLS
+    cache_key = (func_name, json.dumps(arguments, sort_keys=True, default=str))
+    if cacheable and cache_key in state.call_cache:
+        logger.info(f"Skipping repeated call to {func_name}, reusing its earlier result")
+        return arguments, state.call_cache[cache_key], True
+
     result = await session.call_tool(func_name, arguments=arguments)
     iteration_result = None
     if hasattr(result, 'content'):
@@ -239,39 +594,110 @@ async def execute_tool(session, tools, call, iteration_response, conversation_hi
             iteration_result = str(result.content)
     else:
         iteration_result = str(result)
+    if cacheable and (func_name not in SIDE_EFFECT_TOOLS or side_effect_succeeded(result, iteration_result)):
+        state.call_cache[cache_key] = iteration_result
+    return arguments, iteration_result, False
+
+def record_tool_result(call, arguments, iteration_result, state, repeated=False):
+    """Append the outcome of a tool call to the steps reported in the next user turn.
+
+    A repeated call is reported as skipped, so the model does not read the
+    earlier result as a fresh success (e.g. a second email sent).
+    """
+    func_name = call.get("name")
+    reasoning_type = call.get("reasoning_type", "")
+    step_desc = call.get("step", "")
+    if iteration_result is None:
+        state.iteration_response.append(f"Unknown tool: {func_name}")
+        return
 
     result_str = (
         f"[{', '.join(iteration_result)}]" if isinstance(iteration_result, list)
         else str(iteration_result)
     )
-    iteration_response.append(
-        f"Step: {step_desc} | Reasoning: {reasoning_type} | Called {func_name} with {arguments} -> {result_str}"
-    )
-    conversation_history.append({
-        "type": "function_call",
-        "name": func_name,
-        "args": arguments,
-        "reasoning_type": reasoning_type,
-        "step": step_desc,
-        "result": result_str
-    })
-    return iteration_result, iteration_response, conversation_history
-
-def build_prompt(system_prompt, conversation_history, query, last_response, iteration_response):
-    if last_response is None:
-        current_query = query
+    if len(result_str) > MAX_RESULT_CHARS:
+        result_str = result_str[:MAX_RESULT_CHARS - len(TRUNCATION_MARKER)] + TRUNCATION_MARKER
+    if repeated:
+        outcome = (
+            f"Skipped {func_name} with {arguments}: already done earlier in this query, not re-run -> {result_str}"
+        )
     else:
-        current_query = query + "\n\n" + " ".join(iteration_response) + " What should I do next?"
-    prompt = (
-        f"{system_prompt}\n\n"
-        f"Conversation history:\n{json.dumps(conversation_history, indent=2)}\n\n"
-        f"Query: {current_query}"
-    )
-    return prompt
+        outcome = f"Called {func_name} with {arguments} -> {result_str}"
+    state.iteration_response.append(f"Step: {step_desc} | Reasoning: {reasoning_type} | {outcome}")
+
+async def execute_tool(session, tool_index, call, state):
+    arguments, iteration_result, repeated = await call_tool(session, tool_index, call, state)
+    record_tool_result(call, arguments, iteration_result, state, repeated)
+
+def call_signature(call):
+    """Key identifying identical FUNCTION_CALLs (same tool, same raw args) within one LLM response."""
+    return call.get("name"), json.dumps(call.get("args", []), sort_keys=True, default=str)
+
+async def execute_tool_calls(session, tool_index, calls, state):
+    """Execute a batch of FUNCTION_CALLs emitted in one LLM response.
+
+    Consecutive calls to side-effect-free tools are dispatched concurrently with
+    asyncio.gather; calls to tools in SIDE_EFFECT_TOOLS act as ordering barriers
+    and run one at a time. Identical calls within a concurrent batch are dispatched
+    once. Results are recorded in the order the LLM emitted them.
+    """
+    pending = []
+
+    async def flush():
+        if not pending:
+            return
+        unique = {}
+        for c in pending:
+            unique.setdefault(call_signature(c), c)
+        logger.info(f"Dispatching {len(unique)} tool call(s) concurrently")
+        outcomes = await asyncio.gather(*(call_tool(session, tool_index, c, state) for c in unique.values()))
+        outcomes = dict(zip(unique, outcomes))
+        for c in pending:
+            key = call_signature(c)
+            arguments, result, repeated = outcomes[key]
+            record_tool_result(c, arguments, result, state, repeated or c is not unique[key])
+        pending.clear()
+
+    for call in calls:
+        if call.get("name") in SIDE_EFFECT_TOOLS:
+            await flush()
+            await execute_tool(session, tool_index, call, state)
+        else:
+            pending.append(call)
+    await flush()
+
+def build_user_turn(state, query):
+    """Return the next user chat turn: the query first, then only the steps taken since the last model turn."""
+    if not state.messages:
+        text = query
+    else:
+        text = " ".join(state.iteration_response) + " What should I do next?"
+    return {"role": "user", "parts": [text]}
+
+def first_response_line(response_text):
+    """Return the first non-blank line of an LLM response, stripped."""
+    match = _FIRST_LINE_RE.search(response_text)
+    return match.group().strip() if match else ""
+
+def parse_function_calls(response_text):
+    """Decode the JSON payload of each line in the leading block of FUNCTION_CALL lines."""
+    call_block = _FUNCTION_CALL_BLOCK_RE.match(response_text).group()
+    return [json.loads(json_str) for json_str in _FUNCTION_CALL_RE.findall(call_block)]
+
+def is_actionable_response(response_text):
+    """Whether process_llm_response can act on the response."""
+    first_line = first_response_line(response_text)
+    if first_line.startswith(FUNCTION_CALL_PREFIX):
+        try:
+            parse_function_calls(response_text)
+        except ValueError:
+            return False
+        return True
+    return first_line.startswith(("SELF_CHECK:", "FINAL_ANSWER:"))
 
 def handle_final_answer(first_line, query):
     logger.info("=== Agent Execution Complete ===")
-    final_answer = first_line.split(":", 1)[1].strip()
+    final_answer = _FINAL_ANSWER_RE.match(first_line).group(1)
     clean_answer = final_answer.strip('[]')
     if clean_answer.startswith('Query:'):
         clean_answer = clean_answer.split('Result:')[-1].strip()
@@ -282,101 +708,285 @@ def handle_final_answer(first_line, query):
         'answer': clean_answer,
         'full_response': f"Query: {query}\nResult: {clean_answer}"
     }
+    if orjson is not None:
+        return orjson.dumps(response_data, option=orjson.OPT_INDENT_2).decode()
     return json.dumps(response_data, indent=2)
 
-async def process_llm_response(
-    response_text, tools, session, iteration_response, conversation_history, query
-):
-    global last_response
-    first_line = response_text.splitlines()[0].strip()
+async def process_llm_response(response_text, tool_index, session, state, query):
+    first_line = first_response_line(response_text)
     if first_line.startswith(FUNCTION_CALL_PREFIX):
-        json_str = first_line[len(FUNCTION_CALL_PREFIX):].strip()
+        # The LLM may emit several FUNCTION_CALL lines in one response; run the leading block together
         try:
-            call = json.loads(json_str)
+            calls = parse_function_calls(response_text)
         except Exception as e:
             logger.error(f"Failed to parse FUNCTION_CALL JSON: {e}")
-            iteration_response.append(f"Error parsing FUNCTION_CALL JSON: {str(e)}")
+            state.iteration_response.append(f"Error parsing FUNCTION_CALL JSON: {str(e)}")
             return None, True  # End iteration
-        iteration_result, iteration_response, conversation_history = await execute_tool(
-            session, tools, call, iteration_response, conversation_history
-        )
-        last_response = iteration_result
+        await execute_tool_calls(session, tool_index, calls, state)
         return None, False
     elif first_line.startswith("SELF_CHECK:"):
-        conversation_history.append({
-            "type": "self_check",
-            "content": first_line
-        })
-        iteration_response.append(first_line)
+        state.iteration_response.append(first_line)
         return None, False
     elif first_line.startswith("FINAL_ANSWER:"):
         return handle_final_answer(first_line, query), True
     elif first_line.startswith(FUNCTION_CALL_PREFIX) and "fallback_reasoning" in first_line:
-        conversation_history.append({
-            "type": "fallback",
-            "content": first_line
-        })
-        iteration_response.append(first_line)
-        iteration_response.append(first_line)
+        state.iteration_response.append(first_line)
+        state.iteration_response.append(first_line)
         return None, False
     else:
         logger.warning(f"Unrecognized response: {first_line}")
-        iteration_response.append(f"Unrecognized response: {first_line}")
+        state.iteration_response.append(f"Unrecognized response: {first_line}")
         return None, False
 
-async def main(query: str):
-    reset_state()  # Reset at the start of main
-    logger.info(f"Starting main execution with query: {query}")
-    try:
-        logger.info("Establishing connection to MCP server...")
-        server_params = StdioServerParameters(
+class Agent:
+    """Agent that keeps one MCP server subprocess and client session alive across queries.
+
+    Use as an async context manager and serve queries with run():
+
+        async with Agent() as agent:
+            result = await agent.run("What is 2 + 3?")
+
+    The connection is owned by a background task that also pings the server
+    every MCP_PING_INTERVAL seconds and re-establishes the connection if a
+    ping fails.
+    """
+
+    def __init__(self, server_params=None):
+        self.server_params = server_params or StdioServerParameters(
             command="python",
             args=["mcp-server.py", "dev"]
         )
+        self.session = None
+        self.tool_index = ToolIndex.from_tools([])
+        self.tools_description = ""
+        self.system_prompt = ""
+        self.system_prompt_key = ""
+        self.model = None
+        self._ready = asyncio.Event()
+        self._connection_task = None
+
+    async def __aenter__(self):
+        self._connection_task = asyncio.create_task(self._maintain_connection())
+        try:
+            await self.wait_until_ready()
+        except BaseException:
+            await self.__aexit__(None, None, None)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._connection_task is not None:
+            self._connection_task.cancel()
+            try:
+                await self._connection_task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                pass  # startup failure, already logged and raised from wait_until_ready()
+            self._connection_task = None
+        logger.info("MCP connection closed")
+
+    async def wait_until_ready(self):
+        """Wait until a live MCP session is available.
+
+        Raises the connection error right away if the server could not be
+        started at all, instead of waiting out MCP_CONNECT_TIMEOUT.
+        """
+        if self._ready.is_set():
+            return
+        ready = asyncio.ensure_future(self._ready.wait())
+        try:
+            await asyncio.wait(
+                {ready, self._connection_task},
+                timeout=MCP_CONNECT_TIMEOUT,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            ready.cancel()
+        if self._ready.is_set():
+            return
+        if self._connection_task.done():
+            self._connection_task.result()  # re-raises the startup error
+        raise TimeoutError(f"MCP server not ready within {MCP_CONNECT_TIMEOUT}s")
+
+    async def _maintain_connection(self):
+        """Own the MCP subprocess and session, reconnecting whenever the server stops responding.
+
+        If the very first connection attempt fails, the error is raised instead
+        of retried, so callers fail fast when the server cannot start.
+        """
+        connected = False
+        while True:
+            try:
+                logger.info("Establishing connection to MCP server...")
+                async with stdio_client(self.server_params) as (read, write):
+                    logger.info("Connection established, creating session...")
+                    async with ClientSession(read, write) as session:
+                        logger.info("Session created, initializing...")
+                        await session.initialize()
+                        logger.info("Requesting tool list...")
+                        tools_result = await session.list_tools()
+                        await self._set_session(session, tools_result.tools)
+                        self._ready.set()
+                        connected = True
+                        await self._watch_session(session)
+            except Exception as e:
+                logger.error(f"MCP connection error: {e}")
+                if not connected:
+                    raise
+            finally:
+                self._ready.clear()
+                self.session = None
+            await asyncio.sleep(MCP_RECONNECT_DELAY)
+
+    async def _set_session(self, session, tools):
+        """Store the session and build the tool-dependent prompt state for it."""
+        logger.info(f"Successfully retrieved {len(tools)} tools")
+        self.tool_index = ToolIndex.from_tools(tools)
+        self.tools_description = create_tools_description(tools)
+        self.system_prompt = SYSTEM_PROMPT_TEMPLATE.format(tools_description=self.tools_description)
+        self.model = await asyncio.to_thread(get_model, self.system_prompt)
+        self.system_prompt_key = hashlib.sha256(self.system_prompt.encode("utf-8")).hexdigest()
+        self.session = session
+        logger.info("Created system prompt...")
+
+    async def _watch_session(self, session):
+        """Ping the server periodically; return as soon as a ping fails."""
+        while True:
+            await asyncio.sleep(MCP_PING_INTERVAL)
+            try:
+                await asyncio.wait_for(session.send_ping(), timeout=MCP_PING_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"MCP server ping failed, reconnecting: {e!r}")
+                return
 
-        async with stdio_client(server_params) as (read, write):
-            logger.info("Connection established, creating session...")
-            async with ClientSession(read, write) as session:
-                logger.info("Session created, initializing...")
-                await session.initialize()
-                logger.info("Requesting tool list...")
-                tools_result = await session.list_tools()
-                tools = tools_result.tools
-                logger.info(f"Successfully retrieved {len(tools)} tools")
-                tools_description = create_tools_description(tools)
-                system_prompt = SYSTEM_PROMPT_TEMPLATE.format(tools_description=tools_description)
-                logger.info("Created system prompt...")
-                logger.info("Starting iteration loop...")
-                global iteration, last_response, conversation_history
-                while iteration < MAX_ITERATIONS:
-                    logger.info(f"--- Iteration {iteration + 1} ---")
-                    prompt = build_prompt(system_prompt, conversation_history, query, last_response, iteration_response)
-                    try:
-                        response_text = await generate_with_timeout(model, prompt)
-                        response_text = response_text.strip()
-                        logger.info(f"LLM Response: {response_text}")
-                        result, should_break = await process_llm_response(
-                            response_text, tools, session, iteration_response, conversation_history, query
-                        )
-                        if result is not None:
-                            return result
-                        if should_break:
-                            break
-                    except Exception as e:
-                        logger.error(f"Failed to get LLM response: {e}")
+    async def run(self, query: str):
+        """Answer a single query using the persistent MCP session."""
+        state = AgentState()
+        logger.info(f"Starting main execution with query: {query}")
+        try:
+            await self.wait_until_ready()
+            session, tool_index = self.session, self.tool_index
+            system_prompt_key = self.system_prompt_key
+            # Resolved per query: get_model() is memoized and recreates the context cache before it expires
+            model = self.model = await asyncio.to_thread(get_model, self.system_prompt)
+            logger.info("Starting iteration loop...")
+            while state.iteration < MAX_ITERATIONS:
+                logger.info(f"--- Iteration {state.iteration + 1} ---")
+                state.messages.append(build_user_turn(state, query))
+                state.iteration_response.clear()
+                try:
+                    response_text = await generate_with_timeout(
+                        model, list(state.messages), cache_namespace=system_prompt_key
+                    )
+                    response_text = response_text.strip()
+                    state.messages.append({"role": "model", "parts": [response_text]})
+                    logger.info(f"LLM Response: {response_text}")
+                    result, should_break = await process_llm_response(response_text, tool_index, session, state, query)
+                    if result is not None:
+                        return result
+                    if should_break:
                         break
-                    iteration += 1
+                except Exception as e:
+                    logger.exception("Iteration %d failed (%s)", state.iteration + 1, type(e).__name__)
+                    break
+                state.iteration += 1
+        except Exception as e:
+            logger.exception(f"Error in main execution: {e}")
+
+class SharedAgent:
+    """One Agent kept alive on a dedicated event-loop thread for the whole process.
+
+    Callers that each run their own short-lived event loop (such as Flask async
+    views, which get a new loop per request) submit queries to it with run(),
+    so they all share one MCP server and session. The Agent is started on first
+    use, started again on the next use if startup failed, and closed at exit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._started = None  # concurrent.futures.Future resolving to the entered Agent
+
+    def _agent_future(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = (event_loop_factory() or asyncio.new_event_loop)()
+                threading.Thread(target=self._loop.run_forever, name="agent-loop", daemon=True).start()
+                atexit.register(self.close)
+            if self._started is None or (self._started.done() and self._started.exception() is not None):
+                self._started = asyncio.run_coroutine_threadsafe(Agent().__aenter__(), self._loop)
+            return self._started
+
+    async def run(self, query: str):
+        """Answer a query on the shared Agent from any thread's event loop."""
+        agent = await asyncio.wrap_future(self._agent_future())
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(agent.run(query), self._loop))
+
+    def close(self, timeout=MCP_CONNECT_TIMEOUT):
+        """Close the shared Agent's MCP connection and stop its loop thread."""
+        with self._lock:
+            loop, started = self._loop, self._started
+            self._loop = self._started = None
+        if loop is None:
+            return
+        if started is not None and started.done() and started.exception() is None:
+            closing = asyncio.run_coroutine_threadsafe(started.result().__aexit__(None, None, None), loop)
+            try:
+                closing.result(timeout)
+            except Exception as e:
+                logger.warning(f"Could not close the shared agent cleanly: {e!r}")
+        loop.call_soon_threadsafe(loop.stop)
+
+_shared_agent = SharedAgent()
+
+async def main(query: str):
+    """Answer a single query with the process-wide shared Agent."""
+    try:
+        return await _shared_agent.run(query)
     except Exception as e:
-        logger.error(f"Error in main execution: {e}")
-        logger.error(traceback.format_exc())
-    finally:
-        reset_state()  # Reset at the end of main
+        logger.exception(f"Error in main execution: {e}")
+
+async def serve(queries):
+    """Answer several queries concurrently over one shared Agent, returning results in order."""
+    async with Agent() as agent:
+        return await asyncio.gather(*(agent.run(query) for query in queries))
+
+def repl():
+    """Prompt for queries in a loop, reusing one Agent (and MCP server) for all of them.
+
+    Input is read synchronously between queries, outside the event loop, so
+    Ctrl+C and EOF exit right away instead of waiting on a reader thread.
+    """
+    with asyncio.Runner(loop_factory=event_loop_factory()) as runner:
+        agent = runner.run(Agent().__aenter__())
+        try:
+            while True:
+                try:
+                    query = input("Enter your math query (blank to quit): ").strip()
+                except (EOFError, KeyboardInterrupt):
+                    query = ""
+                if not query:
+                    logger.info("No query provided, exiting")
+                    break
+                logger.info(f"User provided query: {query}")
+                result = runner.run(agent.run(query))
+                print(result if result is not None else "Error: The agent could not answer this query")
+        except KeyboardInterrupt:
+            logger.info("Interrupted, exiting")
+        finally:
+            runner.run(agent.__aexit__(None, None, None))
+
+def event_loop_factory():
+    """Return a faster event loop factory (uvloop, or winloop on Windows) if one is installed."""
+    try:
+        if sys.platform == "win32":
+            import winloop as fast_loop
+        else:
+            import uvloop as fast_loop
+    except ImportError:
+        return None
+    return fast_loop.new_event_loop
 
 if __name__ == "__main__":
-    query = input("Enter your math query: ").strip()
-    if not query:
-        logger.error("No query provided by user")
-        print("Error: Please provide a valid math query")
-    else:
-        logger.info(f"User provided query: {query}")
-        asyncio.run(main(query))
+    repl()
@@ -27,7 +27,6 @@ from tools import (
 )
 import logging
 from datetime import datetime
-import traceback
 import smtplib
 from email.mime.text import MIMEText
 from dotenv import load_dotenv
@@ -178,8 +177,7 @@ async def close_powerpoint() -> dict:
             ]
         }
     except Exception as e:
-        logger.error(f"Error in close_powerpoint: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"Error in close_powerpoint: {str(e)}")
         return {
             "content": [
                 TextContent(
@@ -219,8 +217,7 @@ async def open_powerpoint() -> dict:
             ]
         }
     except Exception as e:
-        logger.error(f"Error in open_powerpoint: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"Error in open_powerpoint: {str(e)}")
         return {
             "content": [
                 TextContent(
@@ -336,8 +333,7 @@ async def draw_rectangle(x1: int = 1, y1: int = 1, x2: int = 8, y2: int = 6) ->
             
     except Exception as e:
         error_msg = f"Error in draw_rectangle: {str(e)}"
-        logger.error(error_msg)
-        logger.error(traceback.format_exc())
+        logger.exception(error_msg)
         return {"content": [TextContent(type="text", text=error_msg)]}
 
 @mcp.tool()
@@ -415,8 +411,7 @@ async def add_text_in_powerpoint(text: str) -> dict:
             ]
         }
     except Exception as e:
-        logger.error(f"Error in add_text_in_powerpoint: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"Error in add_text_in_powerpoint: {str(e)}")
         return {
             "content": [
                 TextContent(
@@ -509,8 +504,7 @@ async def send_gmail(content: str) -> dict:
         }
     except Exception as e:
         error_msg = f"Error in send_gmail: {str(e)}"
-        logger.error(error_msg)
-        logger.error(traceback.format_exc())
+        logger.exception(error_msg)
         return {
             "content": [
                 TextContent(
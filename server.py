@@ -1,4 +1,4 @@
-import traceback
+import json
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import logging
@@ -27,7 +27,6 @@ async def handle_query():
         # Parse the JSON response from the AI agent
         try:
             if isinstance(result, str):
-                import json
                 result_data = json.loads(result)
                 if 'result' in result_data:
                     # Return the clean result for the Chrome extension
@@ -57,8 +56,7 @@ async def handle_query():
         })
         
     except Exception as e:
-        logger.error(f"Error processing query: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"Error processing query: {str(e)}")
         return jsonify({
             'status': 'error',
             'message': str(e)